@@ -0,0 +1,215 @@
+#行情 CSV -> Parquet 缓存
+import os
+import json
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+
+try:
+    from numba import njit
+except ImportError:
+    # 未安装 numba 时退化为纯 Python 执行，逻辑不变 (筛选脚本统一从这里导入 njit)
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+        return lambda func: func
+
+# 配置参数
+DATA_DIR = 'stock_data'
+STORE_DIR = 'stock_data_parquet'
+# 小 row group 便于只读取尾部数据 (筛选脚本最多只用最近 300 行)
+ROW_GROUP_SIZE = 64
+
+# 字段映射 (与 stock_data_downloader.TARGET_COLUMNS 对应)
+COL_MAP = {
+    '日期': 'date', '股票代码': 'code', '开盘': 'open', '收盘': 'close',
+    '最高': 'high', '最低': 'low', '成交量': 'volume', '成交额': 'amount',
+    '振幅': 'amplitude', '涨跌幅': 'pct_chg', '涨跌额': 'chg', '换手率': 'turnover'
+}
+CSV_COLUMNS = {v: k for k, v in COL_MAP.items()}
+# 价格 (两位小数) 与成交量 (整数股数) 用 float32 存储，指标计算的内存带宽减半
+FLOAT32_COLUMNS = ('开盘', '收盘', '最高', '最低', '成交量')
+COLUMN_TYPES = {
+    c: (pa.string() if c in ('日期', '股票代码') else pa.float32() if c in FLOAT32_COLUMNS else pa.float64())
+    for c in COL_MAP
+}
+
+# 进程池已按核数并行，单文件解析不再开线程
+READ_OPTIONS = pacsv.ReadOptions(use_threads=False)
+
+# 与 pyarrow CSV 解析一致的空值写法 (下载脚本把 NaN 写成空字段)，尾部读取时转为 null
+NULL_VALUES = np.array([v.encode() for v in pacsv.ConvertOptions().null_values], dtype=bytes)
+
+# 尾部读取的初始块大小 (约 1000 行)，行数不够时按 4 倍扩大
+TAIL_BLOCK = 64 * 1024
+
+# 表头行 -> 各英文列名的字段位置，同一格式的文件只解析一次表头
+_HEADER_POSITIONS = {}
+
+def parquet_path(csv_path):
+    code = os.path.splitext(os.path.basename(csv_path))[0]
+    return os.path.join(STORE_DIR, f'{code}.parquet')
+
+def is_fresh(csv_path, pq_path):
+    """Parquet 缓存存在且不早于 CSV 的修改时间"""
+    try:
+        return os.stat(pq_path).st_mtime_ns >= os.stat(csv_path).st_mtime_ns
+    except FileNotFoundError:
+        return False
+
+def read_csv(csv_path, columns=None):
+    """用 pyarrow 解析 CSV，只读取指定列 (英文列名) 并显式指定类型"""
+    include = [CSV_COLUMNS[c] for c in columns] if columns else None
+    convert_options = pacsv.ConvertOptions(include_columns=include, column_types=COLUMN_TYPES)
+    table = pacsv.read_csv(csv_path, read_options=READ_OPTIONS, convert_options=convert_options)
+    return table.rename_columns([COL_MAP.get(c, c) for c in table.column_names])
+
+def convert_stock(csv_path):
+    """CSV 有更新时重写对应的 Parquet 文件，返回是否发生了转换"""
+    pq_path = parquet_path(csv_path)
+    if is_fresh(csv_path, pq_path): return False
+
+    table = read_csv(csv_path)
+    tmp_path = pq_path + '.tmp'
+    pq.write_table(table, tmp_path, row_group_size=ROW_GROUP_SIZE, use_dictionary=['date'])
+    os.replace(tmp_path, pq_path)
+    return True
+
+def _header_positions(header):
+    positions = _HEADER_POSITIONS.get(header)
+    if positions is None:
+        names = header.decode('utf-8-sig').strip().split(',')
+        positions = {COL_MAP.get(name, name): i for i, name in enumerate(names)}
+        _HEADER_POSITIONS[header] = positions
+    return positions
+
+def read_csv_tail(csv_path, n, columns):
+    """
+    只解析 CSV 的最后 n 行：从文件末尾定长读取一块数据 (不够 n 行时再扩大)，
+    读取量与历史长度无关。要求文件为无引号的逗号分隔格式 (下载脚本的输出格式)。
+    """
+    with open(csv_path, 'rb') as f:
+        header = f.readline()
+        if not header.endswith(b'\n'):
+            raise ValueError(f"无数据行: {csv_path}")
+        positions = _header_positions(header.rstrip(b'\r\n'))
+        data_start = f.tell()
+        size = os.fstat(f.fileno()).st_size
+
+        block = TAIL_BLOCK
+        while True:
+            start = max(data_start, size - block)
+            f.seek(start)
+            buf = f.read().replace(b'\r', b'').rstrip(b'\n')
+            lines = buf.split(b'\n') if buf else []
+            # 块起点不在数据开头时，第一行可能不完整
+            if start > data_start: lines = lines[1:]
+            if len(lines) >= n or start == data_start: break
+            block *= 4
+    lines = lines[-n:]
+
+    # 一次切分全部字段，每列按步长切片后整体转换类型
+    ncols = len(positions)
+    joined = b','.join(lines)
+    if b'"' in joined:
+        raise ValueError(f"不支持带引号的字段: {csv_path}")
+    flat = joined.split(b',') if lines else []
+    if len(flat) != len(lines) * ncols:
+        raise ValueError(f"字段数与表头不符: {csv_path}")
+    data = {}
+    for c in columns:
+        col_type = COLUMN_TYPES[CSV_COLUMNS[c]]
+        values = flat[positions[c]::ncols]
+        if col_type == pa.string():
+            data[c] = pa.array(values, type=col_type)
+        else:
+            raw = np.array(values, dtype=bytes)
+            nulls = np.isin(raw, NULL_VALUES)
+            # np.where 会按需加宽字节串类型 (全为空字段时原数组宽度只有 1)
+            if nulls.any(): raw = np.where(nulls, b'nan', raw)
+            data[c] = pa.array(raw.astype(col_type.to_pandas_dtype()), type=col_type, mask=nulls)
+    return pa.table(data)
+
+def read_tail(csv_path, n, columns):
+    """
+    读取最近 n 行的指定列 (历史不足 n 行时返回全部)，返回 pyarrow.Table。
+    有新鲜的 Parquet 缓存时只读取覆盖最后 n 行的 row group，否则回退到只解析 CSV 尾部。
+    """
+    pq_path = parquet_path(csv_path)
+    if not is_fresh(csv_path, pq_path):
+        return read_csv_tail(csv_path, n, columns)
+
+    pf = pq.ParquetFile(pq_path)
+    meta = pf.metadata
+    groups, rows = [], 0
+    for i in range(meta.num_row_groups - 1, -1, -1):
+        groups.append(i)
+        rows += meta.row_group(i).num_rows
+        if rows >= n: break
+    table = pf.read_row_groups(groups[::-1], columns=columns)
+    return table.slice(max(table.num_rows - n, 0))
+
+def load_run_state(path, version):
+    """读取上次运行记录 {code: [mtime_ns, result]}，版本不符或文件损坏时返回空记录"""
+    try:
+        with open(path, encoding='utf-8') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return state.get('files', {}) if state.get('version') == version else {}
+
+def save_run_state(path, version, files):
+    """先写临时文件再替换，保证记录文件始终完整"""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'version': version, 'files': files}, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def partition_by_state(entries, codes, state):
+    """
+    按上次运行记录划分文件：修改时间未变的直接复用上次结果，其余需要重新判定。
+    (删除记录文件即可全量重跑；判定逻辑或参数变化时调用方需递增版本号使旧记录失效)
+    entries 为 os.scandir 条目，codes 为对应的 6 位代码。
+    返回 (new_state, cached, pending)：new_state 为已复用的记录，cached 为 {code: 上次结果}，
+    pending 为待判定的 [(path, code, mtime_ns)]。
+    """
+    new_state, cached, pending = {}, {}, []
+    for e, code in zip(entries, codes):
+        mtime = e.stat().st_mtime_ns
+        record = state.get(code)
+        if record and record[0] == mtime:
+            new_state[code] = record
+            cached[code] = record[1]
+        else:
+            pending.append((e.path, code, mtime))
+    return new_state, cached, pending
+
+def write_csv(df, path):
+    """用 pyarrow 写出 DataFrame 为带 BOM 的 UTF-8 CSV (与 to_csv(encoding='utf-8-sig') 一致，便于 Excel 打开)"""
+    with open(path, 'wb') as f:
+        f.write(b'\xef\xbb\xbf')
+        pacsv.write_csv(pa.Table.from_pandas(df, preserve_index=False), f)
+
+def stock_csv_paths():
+    """个股行情文件 (6 位代码命名)，跳过名单等其他 CSV"""
+    for entry in os.scandir(DATA_DIR):
+        name, ext = os.path.splitext(entry.name)
+        if ext == '.csv' and name.isdigit():
+            yield entry.path
+
+def main():
+    if not os.path.exists(DATA_DIR): return
+    os.makedirs(STORE_DIR, exist_ok=True)
+
+    converted = 0
+    for path in stock_csv_paths():
+        try:
+            converted += convert_stock(path)
+        except (pa.ArrowInvalid, OSError) as e:
+            print(f"转换失败 {os.path.basename(path)}: {e}")
+    print(f"Parquet 缓存更新完成：本次转换 {converted} 个文件。")
+
+if __name__ == '__main__':
+    main()
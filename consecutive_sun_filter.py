@@ -1,103 +1,189 @@
 #连阳缩倍量
 import os
+import cProfile
+import functools
+import logging
+import pstats
 import pandas as pd
 import numpy as np
 from datetime import datetime
-from concurrent.futures import ProcessPoolExecutor
+from cache_store import njit, read_tail, load_run_state, save_run_state, partition_by_state, write_csv
 
 # 配置参数
 DATA_DIR = 'stock_data'
 NAMES_FILE = 'stock_names.csv'
 OUTPUT_BASE = 'results'
 
-# 字段映射
-COL_MAP = {
-    '日期': 'date', '开盘': 'open', '最高': 'high', 
-    '最低': 'low', '收盘': 'close', '成交量': 'volume'
-}
+# 形态判断只需要最近 10 天的收盘/开盘/成交量
+TAIL_COLUMNS = ['close', 'open', 'volume']
+WINDOW = 10
+MIN_HISTORY = 15
 
-def is_consecutive_sun_model(df):
+# 增量运行记录 (规则见 cache_store.partition_by_state)
+STATE_PATH = os.path.join(OUTPUT_BASE, '.last_run_consecutive_sun.json')
+STATE_VERSION = 1
+
+# PROFILE=1 时用 cProfile 记录加载与判定过程并打印耗时最高的函数 (单进程，每次运行覆盖同一个 .prof 文件)
+PROFILE = os.environ.get('PROFILE') == '1'
+PROFILE_DIR = os.path.join(OUTPUT_BASE, 'profile')
+
+# 日志级别 (如 LOG_LEVEL=DEBUG 时打印每个读取失败的文件)
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'WARNING').upper()
+
+# 判定引擎：默认对全部个股整体向量化；SUN_ENGINE=numba 时逐只调用 numba 编译的判定函数
+SUN_ENGINE = os.environ.get('SUN_ENGINE', 'numpy')
+
+@njit(cache=True)
+def is_consecutive_sun_model(c, o, v):
     """
     "连阳缩倍量" 模型逻辑实现:
     1. 连阳建仓：过去 6-10 天内存在连续 4 根以上阳线，且连阳末端成交量为阶段最大量。
     2. 缩倍量洗盘：在最大量之后，出现 1-3 天的调整，成交量缩至最大量的 50% 以下。
     3. 倍量突破：当日（最新一天）为阳线，成交量是前一日的 1.8 倍以上，且收盘价站上洗盘区高点。
+
+    c, o, v 为最近 10 天的收盘价、开盘价、成交量 (float32 数组)，由 numba 编译为机器码。
     """
-    if len(df) < 15: return False
-    
+    n = len(v)
+
     # 基础过滤：价格 5-20 元
-    last_price = df['close'].iloc[-1]
+    last_price = c[n - 1]
     if not (5.0 <= last_price <= 20.0): return False
 
-    # 定义回溯区间
-    # 假设最近 1 天是突破日，前 1-3 天是洗盘区，再往前是连阳区
-    # 我们检查最近 10 天的数据
-    data = df.tail(10).copy()
-    volumes = data['volume'].values
-    closes = data['close'].values
-    opens = data['open'].values
-    
     # 1. 寻找阶段最大成交量（主力建仓标志）及其位置
     # 最大量不应出现在最后一天（因为最后一天是突破日），应在前 2-5 天内
-    lookback_data = data.iloc[:-1] 
-    max_vol_idx = lookback_data['volume'].argmax()
-    max_vol = lookback_data['volume'].iloc[max_vol_idx]
-    
+    max_idx = 0
+    max_vol = v[0]
+    for i in range(1, n - 1):
+        if v[i] > max_vol:
+            max_vol = v[i]
+            max_idx = i
+
     # 最大量位置距离今天太远或太近都不符合形态（要求给洗盘留出 1-4 天空间）
-    dist_from_now = len(lookback_data) - max_vol_idx
+    dist_from_now = n - 1 - max_idx
     if not (1 <= dist_from_now <= 4): return False
 
     # 2. 检查连阳建仓段 (在最大量坐标及其之前)
     # 要求最大量当天是阳线，且之前至少有连续阳线趋势
-    if closes[max_vol_idx] <= opens[max_vol_idx]: return False
-    
+    if c[max_idx] <= o[max_idx]: return False
+
     # 3. 检查缩倍量洗盘段 (最大量之后到今天之前)
-    wash_zone = data.iloc[max_vol_idx + 1 : -1]
-    if wash_zone.empty: return False
-    
+    if max_idx + 1 >= n - 1: return False
+    min_wash_vol = v[max_idx + 1]
+    max_wash_close = c[max_idx + 1]
+    for i in range(max_idx + 2, n - 1):
+        if v[i] < min_wash_vol:
+            min_wash_vol = v[i]
+        if c[i] > max_wash_close:
+            max_wash_close = c[i]
+
     # 洗盘区最小成交量必须小于最大量的 50%
-    min_wash_vol = wash_zone['volume'].min()
     if min_wash_vol > (max_vol * 0.5): return False
 
     # 4. 检查倍量突破段 (今天)
-    today = data.iloc[-1]
-    yesterday = data.iloc[-2]
-    
-    is_today_sun = today['close'] > today['open']
+    is_today_sun = c[n - 1] > o[n - 1]
     # 倍量确认：今天量 > 昨天量 * 1.8 且 突破洗盘区最高收盘价
-    vol_confirm = today['volume'] > (yesterday['volume'] * 1.8)
-    price_break = today['close'] >= wash_zone['close'].max()
+    vol_confirm = v[n - 1] > (v[n - 2] * 1.8)
+    price_break = c[n - 1] >= max_wash_close
 
     return is_today_sun and vol_confirm and price_break
 
-def process_stock(file_name):
-    code = file_name.split('.')[0]
-    if code.startswith('30'): return None # 排除创业板
-    
-    try:
-        df = pd.read_csv(os.path.join(DATA_DIR, file_name))
-        df = df.rename(columns=COL_MAP)
-        if df.empty or len(df) < 15: return None
-        
-        if is_consecutive_sun_model(df):
-            return code
-    except:
-        return None
-    return None
+def scan_consecutive_sun(C, O, V):
+    """
+    与 is_consecutive_sun_model 相同的判定，对 (n, 10) 的收盘/开盘/成交量矩阵整体向量化计算。
+    历史不足的行为 NaN，所有比较均为 False。返回长度为 n 的布尔数组。
+    """
+    rows = np.arange(len(V))
+    lookback_v = V[:, :-1]
+    lookback_c = C[:, :-1]
+
+    # 阶段最大量及其位置
+    max_idx = lookback_v.argmax(axis=1)
+    max_vol = lookback_v[rows, max_idx]
+    dist_from_now = lookback_v.shape[1] - max_idx
+
+    # 洗盘区：最大量之后到今天之前
+    wash = np.arange(lookback_v.shape[1])[None, :] > max_idx[:, None]
+    min_wash_vol = np.where(wash, lookback_v, np.inf).min(axis=1)
+    max_wash_close = np.where(wash, lookback_c, -np.inf).max(axis=1)
+
+    # 每个条件一个布尔掩码，最后一次性按位与合并
+    last_close, last_open, last_vol = C[:, -1], O[:, -1], V[:, -1]
+    masks = [
+        (last_close >= 5.0) & (last_close <= 20.0),                   # 价格 5-20 元
+        (dist_from_now >= 1) & (dist_from_now <= 4),                  # 最大量距今 1-4 天
+        C[rows, max_idx] > O[rows, max_idx],                          # 最大量当天为阳线
+        min_wash_vol <= max_vol * 0.5,                                # 洗盘区缩量至一半以下 (空洗盘区为 inf)
+        last_close > last_open,                                       # 今日阳线
+        last_vol > V[:, -2] * 1.8,                                    # 倍量
+        last_close >= max_wash_close,                                 # 突破洗盘区最高收盘价
+    ]
+    return functools.reduce(np.logical_and, masks)
+
+def load_tails(file_paths):
+    """
+    把每只股票最近 10 天数据装入 (n, 10) 矩阵，读取失败或历史不足 15 天的行保持 NaN。
+    另返回 loaded 布尔数组，读取失败的行为 False (与历史不足的未入选区分开)。
+    """
+    shape = (len(file_paths), WINDOW)
+    C, O, V = (np.full(shape, np.nan, dtype=np.float32) for _ in range(3))
+    loaded = np.ones(len(file_paths), dtype=bool)
+    for i, path in enumerate(file_paths):
+        try:
+            table = read_tail(path, MIN_HISTORY, TAIL_COLUMNS)
+        except (OSError, ValueError, KeyError, IndexError) as e:
+            # 文件缺失/损坏或字段缺失时该行保持 NaN
+            logging.debug(f"跳过 {path}: {e!r}")
+            loaded[i] = False
+            continue
+        if table.num_rows < MIN_HISTORY: continue
+        tail = table.slice(MIN_HISTORY - WINDOW)
+        C[i] = tail.column('close').to_numpy()
+        O[i] = tail.column('open').to_numpy()
+        V[i] = tail.column('volume').to_numpy()
+    return C, O, V, loaded
 
 def main():
+    logging.basicConfig(level=LOG_LEVEL, format='%(message)s')
     if not os.path.exists(NAMES_FILE): return
     names_df = pd.read_csv(NAMES_FILE)
     names_df['code'] = names_df['code'].astype(str).str.zfill(6)
-    names_df = names_df[~names_df['name'].str.contains('ST|st')]
-    valid_codes = set(names_df['code'])
+    names = names_df['name']
+    is_st = names.str.contains('ST', regex=False, na=False) | names.str.contains('st', regex=False, na=False)
+    names_df = names_df[~is_st]
+
+    # 文件名中的代码一次性补齐 6 位后与名单比对，排除创业板
+    entries = [e for e in os.scandir(DATA_DIR) if e.name.endswith('.csv')]
+    all_codes = np.char.zfill(np.array([e.name[:-4] for e in entries], dtype=str), 6)
+    board_mask = ~np.char.startswith(all_codes, '30')
+    valid_mask = np.isin(all_codes, names_df['code'].to_numpy()) & board_mask
+    codes = all_codes[valid_mask]
+    valid_entries = [e for e, m in zip(entries, valid_mask) if m]
+
+    # 未修改的文件直接复用上次结果，只加载有变化的文件
+    state = load_run_state(STATE_PATH, STATE_VERSION)
+    new_state, cached, pending = partition_by_state(valid_entries, codes.tolist(), state)
+    hit_codes = [code for code, hit in cached.items() if hit]
+
+    profiler = cProfile.Profile() if PROFILE else None
+    if profiler: profiler.enable()
+
+    C, O, V, loaded = load_tails([path for path, _, _ in pending])
+    if SUN_ENGINE == 'numba':
+        hits = np.array([is_consecutive_sun_model(C[i], O[i], V[i]) for i in range(len(pending))], dtype=bool)
+    else:
+        hits = scan_consecutive_sun(C, O, V)
+
+    if profiler:
+        profiler.disable()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        profiler.dump_stats(os.path.join(PROFILE_DIR, 'consecutive_sun.prof'))
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
 
-    files = [f for f in os.listdir(DATA_DIR) if f.endswith('.csv') and f.split('.')[0] in valid_codes]
-    
-    with ProcessPoolExecutor() as executor:
-        results = list(executor.map(process_stock, files))
-    
-    hit_codes = [c for c in results if c is not None]
+    # 读取失败的文件不写入运行记录，下次运行会重试
+    for (_, code, mtime), hit, ok in zip(pending, hits.tolist(), loaded.tolist()):
+        if ok: new_state[code] = [mtime, hit]
+        if hit: hit_codes.append(code)
+    save_run_state(STATE_PATH, STATE_VERSION, new_state)
 
     # 输出
     now = datetime.now()
@@ -107,8 +193,10 @@ def main():
 
     final_df = names_df[names_df['code'].isin(hit_codes)]
     file_path = os.path.join(month_dir, f'consecutive_sun_{ts}.csv')
-    final_df.to_csv(file_path, index=False, encoding='utf-8-sig')
+    write_csv(final_df, file_path)
     print(f"筛选完成：匹配到 {len(final_df)} 只符合'连阳缩倍量'形态的个股。")
+    skipped = int((~loaded).sum())
+    if skipped: print(f"读取失败已跳过 {skipped} 个文件 (LOG_LEVEL=DEBUG 可查看明细)。")
 
 if __name__ == '__main__':
     main()
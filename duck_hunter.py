@@ -1,135 +1,243 @@
 import pandas as pd
+import numpy as np
+import bottleneck as bn
 import os
-import glob
+import cProfile
+import logging
+import pstats
 from datetime import datetime
 from multiprocessing import Pool, cpu_count
-import re
+from multiprocessing.util import Finalize
+from cache_store import njit, read_tail, load_run_state, save_run_state, partition_by_state, write_csv
 
 # 配置常量
 DATA_DIR = 'stock_data'
 NAMES_FILE = 'stock_names.csv'
 OUTPUT_BASE = 'results' # 基础目录保持不变
 
-def analyze_logic(file_path):
+# 用到的字段
+COLUMNS = ['date', 'close', 'high', 'volume', 'pct_chg', 'turnover']
+
+# PROFILE=1 时每个工作进程记录 cProfile 数据，按进程号写入 .prof 文件后由主进程汇总
+PROFILE = os.environ.get('PROFILE') == '1'
+PROFILE_DIR = os.path.join(OUTPUT_BASE, 'profile')
+_profiler = None
+
+# 日志级别 (如 LOG_LEVEL=DEBUG 时打印每个读取失败的文件)
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'WARNING').upper()
+
+# 增量运行记录 (规则见 cache_store.partition_by_state)
+STATE_PATH = os.path.join(OUTPUT_BASE, '.last_run_duck_hunter.json')
+STATE_VERSION = 2
+
+# 分级以整数存储 (数值越大级别越高)，只在输出时转换为文字
+LEVEL_A, LEVEL_AA, LEVEL_AAA = 1, 2, 3
+LEVEL_NAMES = {LEVEL_A: 'A', LEVEL_AA: 'AA', LEVEL_AAA: 'AAA'}
+
+# 指标计算只保留最近 300 根 K 线 (MA60/EMA26 已充分收敛)
+TAIL_ROWS = 300
+
+def tail_mean(x, window, count):
+    """最近 count 个位置的 window 日移动平均 (只在需要的尾部区间上计算)"""
+    return bn.move_mean(x[-(window + count - 1):], window)[-count:]
+
+@njit(cache=True)
+def macd_fused(close):
+    """
+    MACD (12, 26, 9) 单次遍历计算 dif / dea / macd 柱。
+    各 EMA 递推式与 pandas ewm(span, adjust=False).mean() 一致，均以首个值为初值。
+    """
+    a12 = 2.0 / 13.0
+    a26 = 2.0 / 27.0
+    a9 = 2.0 / 10.0
+    n = len(close)
+    dif = np.empty(n)
+    dea = np.empty(n)
+    macd = np.empty(n)
+    e12 = close[0]
+    e26 = close[0]
+    d_ema = 0.0
+    for i in range(n):
+        e12 += a12 * (close[i] - e12)
+        e26 += a26 * (close[i] - e26)
+        d = e12 - e26
+        d_ema += a9 * (d - d_ema)
+        dif[i] = d
+        dea[i] = d_ema
+        macd[i] = (d - d_ema) * 2
+    return dif, dea, macd
+
+def _init_worker():
+    """进程池初始化：预先加载 numba 编译缓存，避免首个任务承担编译开销"""
+    logging.basicConfig(level=LOG_LEVEL, format='%(message)s')
+    warm = np.zeros(2, dtype=np.float32)
+    warm.flags.writeable = False  # pyarrow 零拷贝转换得到的是只读数组
+    macd_fused(warm)
+
+    global _profiler
+    if PROFILE:
+        _profiler = cProfile.Profile()
+        prof_path = os.path.join(PROFILE_DIR, f'duck_hunter_{os.getpid()}.prof')
+        Finalize(_profiler, _profiler.dump_stats, args=(prof_path,), exitpriority=10)
+
+def run_task(file_path):
+    """
+    工作进程入口，返回 (file_path, 结果, 是否读取失败)；开启 PROFILE 时在 profiler 下执行 analyze_logic。
+    读取失败与未入选分开标记，失败的文件不写入增量运行记录，下次运行会重试。
+    """
     try:
-        # 1. 加载数据
-        df = pd.read_csv(file_path)
-        
-        # 【过滤1：排除次新股】要求上市时间超过180个交易日
-        if len(df) < 180: return None
-        
-        # 表头映射
-        df = df.rename(columns={
-            '日期':'date', '股票代码':'code', '开盘':'open', 
-            '收盘':'close', '最高':'high', '最低':'low', 
-            '成交量':'volume', '涨跌幅':'pct_chg', '换手率':'turnover'
-        })
-        
-        # 格式化代码并过滤板块 (只要沪深A股 60/00)
-        code_raw = str(df.iloc[-1]['code']).split('.')[0]
-        code = code_raw.zfill(6)
-        if not (code.startswith('60') or code.startswith('00')):
-            return None
-
-        # 2. 基础过滤：价格与活跃度
-        curr = df.iloc[-1]
-        
-        # 价格区间：5 - 28元
-        if not (5.0 <= curr['close'] <= 28.0): return None
-        
-        # 【过滤2：强势突破基因】当日涨幅 >= 3.0%
-        cond_strong = curr['pct_chg'] >= 3.0
-        # 【过滤3：换手活跃度】换手率 > 3.0%
-        cond_active = curr['turnover'] > 3.0
-        
-        if not (cond_strong and cond_active):
-            return None
-
-        # 3. 技术指标计算
-        df['ma5'] = df['close'].rolling(5).mean()
-        df['ma10'] = df['close'].rolling(10).mean()
-        df['ma20'] = df['close'].rolling(20).mean()
-        df['ma60'] = df['close'].rolling(60).mean()
-        df['vol_ma5'] = df['volume'].rolling(5).mean()
-        df['vol_ma60'] = df['volume'].rolling(60).mean()
-        
-        # MACD (12, 26, 9)
-        exp1 = df['close'].ewm(span=12, adjust=False).mean()
-        exp2 = df['close'].ewm(span=26, adjust=False).mean()
-        df['dif'] = exp1 - exp2
-        df['dea'] = df['dif'].ewm(span=9, adjust=False).mean()
-        df['macd'] = (df['dif'] - df['dea']) * 2
-
-        prev = df.iloc[-2]
-        recent_10 = df.iloc[-10:-1]
-        recent_20 = df.iloc[-20:-1]
-
-        # --- 分级判定逻辑 ---
-        
-        # 【A级：基础强势】
-        cond_basic_trend = curr['close'] > curr['ma5'] > curr['ma10']
-        cond_basic_slope = curr['ma5'] > prev['ma5']
-        cond_basic_vol = (curr['volume'] > curr['vol_ma5'] * 1.2) or (curr['close'] >= curr['ma10'] and curr['volume'] <= curr['vol_ma5'])
-        
-        if not (cond_basic_trend and cond_basic_slope and cond_basic_vol):
-            return None
-        
-        level = "A"
+        if _profiler is None:
+            return file_path, analyze_logic(file_path), False
+        return file_path, _profiler.runcall(analyze_logic, file_path), False
+    except (OSError, ValueError, KeyError, IndexError) as e:
+        # 文件缺失/损坏或字段缺失时跳过该股票
+        logging.debug(f"跳过 {file_path}: {e!r}")
+        return file_path, None, True
 
-        # 【AA级：标准形态】
-        cond_aa_trend = curr['ma60'] > df.iloc[-5]['ma60']
-        cond_aa_macd = curr['macd'] > prev['macd']
-        
-        if cond_aa_trend and cond_aa_macd:
-            level = "AA"
-
-            # 【AAA级：极品老鸭头】
-            cond_aaa_head = recent_20['high'].max() > curr['ma60'] * 1.08
-            cond_aaa_nostril = recent_10['volume'].min() < curr['vol_ma60'] * 0.8
-            cond_aaa_water = curr['dif'] > 0
-            
-            if cond_aaa_head and cond_aaa_nostril and cond_aaa_water:
-                level = "AAA"
-
-        return {
-            'filter_date': curr['date'],
-            'code': code, 
-            'name': None, 
-            'level': level,
-            'price': round(curr['close'], 2), 
-            'pct_chg': f"{curr['pct_chg']}%",
-            'turnover': f"{curr['turnover']}%",
-            'vol_ratio': round(curr['volume'] / curr['vol_ma5'], 2)
-        }
-            
-    except Exception:
+def print_profile(top=20):
+    """汇总各工作进程的 .prof 文件并打印累计耗时最高的函数"""
+    paths = [e.path for e in os.scandir(PROFILE_DIR) if e.name.startswith('duck_hunter_') and e.name.endswith('.prof')]
+    if not paths: return
+    pstats.Stats(*paths).sort_stats('cumulative').print_stats(top)
+
+def analyze_logic(file_path):
+    """判定单只股票，未入选返回 None；读取失败时抛出异常，由 run_task 处理"""
+    # 1. 加载数据
+    table = read_tail(file_path, TAIL_ROWS, COLUMNS)
+    
+    # 【过滤1：排除次新股】要求上市时间超过180个交易日
+    if table.num_rows < 180: return None
+    
+    # 2. 基础过滤先行：只取最后一行的标量，未通过则直接返回，不做任何指标计算
+    curr = table.slice(table.num_rows - 1).to_pylist()[0]
+    curr_close, curr_pct, curr_turn = curr['close'], curr['pct_chg'], curr['turnover']
+    # 最新一行价格/涨幅/换手率为空值时按未入选处理
+    if curr_close is None or curr_pct is None or curr_turn is None: return None
+    
+    # 价格区间：5 - 28元
+    if not (5.0 <= curr_close <= 28.0): return None
+    
+    # 【过滤2：强势突破基因】当日涨幅 >= 3.0%
+    cond_strong = curr_pct >= 3.0
+    # 【过滤3：换手活跃度】换手率 > 3.0%
+    cond_active = curr_turn > 3.0
+    
+    if not (cond_strong and cond_active):
         return None
 
+    # 3. 技术指标计算 (只计算判定用到的位置)
+    close = table.column('close').to_numpy()
+    high = table.column('high').to_numpy()
+    volume = table.column('volume').to_numpy()
+
+    ma5 = tail_mean(close, 5, 2)
+    ma10 = tail_mean(close, 10, 1)[-1]
+    ma60 = tail_mean(close, 60, 5)
+    vol_ma5 = tail_mean(volume, 5, 1)[-1]
+    vol_ma60 = tail_mean(volume, 60, 1)[-1]
+    
+    # MACD (12, 26, 9)
+    dif, dea, macd = macd_fused(close)
+
+    curr_vol = volume[-1]
+
+    # --- 分级判定逻辑 ---
+    
+    # 【A级：基础强势】
+    cond_basic_trend = curr_close > ma5[-1] > ma10
+    cond_basic_slope = ma5[-1] > ma5[-2]
+    cond_basic_vol = (curr_vol > vol_ma5 * 1.2) or (curr_close >= ma10 and curr_vol <= vol_ma5)
+    
+    if not (cond_basic_trend and cond_basic_slope and cond_basic_vol):
+        return None
+    
+    level = LEVEL_A
+
+    # 【AA级：标准形态】
+    cond_aa_trend = ma60[-1] > ma60[-5]
+    cond_aa_macd = macd[-1] > macd[-2]
+    
+    if cond_aa_trend and cond_aa_macd:
+        level = LEVEL_AA
+
+        # 【AAA级：极品老鸭头】
+        cond_aaa_head = high[-20:-1].max() > ma60[-1] * 1.08
+        cond_aaa_nostril = volume[-10:-1].min() < vol_ma60 * 0.8
+        cond_aaa_water = dif[-1] > 0
+        
+        if cond_aaa_head and cond_aaa_nostril and cond_aaa_water:
+            level = LEVEL_AAA
+
+    # (filter_date, level, price, pct_chg, turnover, vol_ratio)；代码与板块由 main 按文件名处理
+    # 价格/成交量以 float32 计算，输出前转回 float64
+    return (curr['date'], level, round(curr_close, 2), curr_pct, curr_turn, round(float(curr_vol / vol_ma5), 2))
+
 def main():
+    logging.basicConfig(level=LOG_LEVEL, format='%(message)s')
     if not os.path.exists(NAMES_FILE): return
     
     names_df = pd.read_csv(NAMES_FILE, dtype={'code': str})
-    names_df = names_df[~names_df['name'].str.contains(r'ST|退|\*ST', na=False)]
-    valid_codes = set(names_df['code'].apply(lambda x: x.zfill(6)).tolist())
+    # 子串匹配 (regex=False) 代替正则，'*ST' 已包含在 'ST' 中
+    names = names_df['name']
+    is_st = names.str.contains('ST', regex=False, na=False) | names.str.contains('退', regex=False, na=False)
+    names_df = names_df[~is_st]
+    name_dict = dict(zip(names_df['code'].str.zfill(6), names_df['name']))
 
-    files = [f for f in glob.glob(f'{DATA_DIR}/*.csv') if os.path.basename(f).split('.')[0].zfill(6) in valid_codes]
+    # 文件名中的代码一次性补齐 6 位后与名单比对，并过滤板块 (只要沪深A股 60/00)
+    entries = [e for e in os.scandir(DATA_DIR) if e.name.endswith('.csv')] if os.path.isdir(DATA_DIR) else []
+    codes = np.char.zfill(np.array([e.name[:-4] for e in entries], dtype=str), 6)
+    board_mask = np.char.startswith(codes, '60') | np.char.startswith(codes, '00')
+    valid_mask = np.isin(codes, list(name_dict)) & board_mask
+    valid_entries = [e for e, m in zip(entries, valid_mask) if m]
     
-    if not files:
+    if not valid_entries:
         print("Stock data directory is empty.")
         return
 
-    with Pool(cpu_count()) as p:
-        results = p.map(analyze_logic, files)
-    
-    results = [r for r in results if r is not None]
+    # 未修改的文件直接复用上次结果，只把有变化的文件交给进程池
+    state = load_run_state(STATE_PATH, STATE_VERSION)
+    new_state, cached, pending = partition_by_state(valid_entries, codes[valid_mask].tolist(), state)
+    results = [(code, *r) for code, r in cached.items() if r is not None]
+    pending = {path: (code, mtime) for path, code, mtime in pending}
+    files = list(pending)
+    skipped = 0
+
+    if files:
+        # 按块分发任务，摊薄每个任务的进程间通信开销
+        workers = cpu_count()
+        chunksize = max(1, len(files) // (workers * 4))
+        if PROFILE:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            for e in os.scandir(PROFILE_DIR):
+                if e.name.startswith('duck_hunter_') and e.name.endswith('.prof'): os.remove(e.path)
+        with Pool(workers, initializer=_init_worker) as p:
+            for file_path, r, failed in p.imap_unordered(run_task, files, chunksize=chunksize):
+                if failed:
+                    skipped += 1
+                    continue
+                code, mtime = pending[file_path]
+                new_state[code] = [mtime, r]
+                if r is not None: results.append((code, *r))
+            # 让工作进程正常退出，以便写出 profile 数据
+            p.close()
+            p.join()
+        if PROFILE:
+            print_profile()
+    save_run_state(STATE_PATH, STATE_VERSION, new_state)
     
     if results:
-        res_df = pd.DataFrame(results)
-        name_dict = names_df.set_index(names_df['code'].apply(lambda x: x.zfill(6)))['name'].to_dict()
+        # 按列一次性构造结果表
+        codes, dates, levels, prices, pcts, turns, vol_ratios = zip(*results)
+        res_df = pd.DataFrame({
+            'filter_date': dates, 'code': codes, 'level': np.array(levels, dtype=np.int8),
+            'price': np.array(prices), 'pct_chg': np.array(pcts),
+            'turnover': np.array(turns), 'vol_ratio': np.array(vol_ratios)
+        })
         res_df['name'] = res_df['code'].map(name_dict)
         
-        # 排序逻辑
-        res_df = res_df.sort_values(by=['level', 'pct_chg'], ascending=[False, False])
+        # 排序逻辑：级别与涨幅均为数值列，按数值降序；并列时按代码升序，
+        # 使输出顺序不受进程池完成顺序和增量缓存的影响
+        res_df = res_df.sort_values(by=['level', 'pct_chg', 'code'], ascending=[False, False, True])
         
         # --- 路径修改：统一保存到 results/duck_hunter/ ---
         now = datetime.now()
@@ -140,19 +248,28 @@ def main():
         save_path = os.path.join(dir_path, f"duck_hunter_{now.strftime('%Y%m%d')}.csv")
         
         final_cols = ['filter_date', 'code', 'name', 'level', 'price', 'pct_chg', 'turnover', 'vol_ratio']
-        res_df[final_cols].to_csv(save_path, index=False, encoding='utf-8-sig') # 增加编码防止乱码
+        # 级别/涨幅/换手率保持数值参与排序，只在写文件时格式化为文本
+        out_df = res_df[final_cols].assign(
+            level=res_df['level'].map(LEVEL_NAMES),
+            pct_chg=res_df['pct_chg'].map('{:.2f}%'.format),
+            turnover=res_df['turnover'].map('{:.2f}%'.format)
+        )
+        write_csv(out_df, save_path) # 带 BOM 防止乱码
+        # 同时输出 Parquet (涨幅/换手率保持数值)，下游脚本可免去 CSV 解析
+        res_df[final_cols].assign(level=out_df['level']).to_parquet(os.path.splitext(save_path)[0] + '.parquet', index=False)
         
         counts = res_df['level'].value_counts()
         print("-" * 50)
         print(f"筛选日期: {res_df['filter_date'].iloc[0]}")
         print(f"总计入选: {len(res_df)} 只")
-        print(f"AAA 级 (极品老鸭): {counts.get('AAA', 0)} 只")
-        print(f"AA  级 (标准形态): {counts.get('AA', 0)} 只")
-        print(f"A    级 (基础强势): {counts.get('A', 0)} 只")
+        print(f"AAA 级 (极品老鸭): {counts.get(LEVEL_AAA, 0)} 只")
+        print(f"AA  级 (标准形态): {counts.get(LEVEL_AA, 0)} 只")
+        print(f"A    级 (基础强势): {counts.get(LEVEL_A, 0)} 只")
         print(f"保存路径: {save_path}")
         print("-" * 50)
     else:
         print(f"今日 ({datetime.now().strftime('%Y-%m-%d')}) 无符合强势老鸭头形态的股票。")
+    if skipped: print(f"读取失败已跳过 {skipped} 个文件 (LOG_LEVEL=DEBUG 可查看明细)。")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,69 @@
+#尾部读取 (read_csv_tail) 与 pyarrow 全量解析 (即 Parquet 缓存内容) 的一致性测试
+import pytest
+from cache_store import COL_MAP, read_csv, read_csv_tail
+
+HEADER = ','.join(COL_MAP)
+COLUMNS = list(COL_MAP.values())
+
+def make_rows(count):
+    """生成与下载脚本输出格式一致的行情数据行"""
+    rows = []
+    for i in range(count):
+        close = 10 + i % 7 * 0.13
+        rows.append(f"2024-01-{i % 28 + 1:02d},000001,{close - 0.1:.2f},{close:.2f},{close + 0.2:.2f},"
+                    f"{close - 0.3:.2f},{100000 + i},{1.5e8 + i},{2.5},{0.33},{0.03},{1.25}")
+    return rows
+
+def write_file(tmp_path, rows, newline='\n', bom=False, final_newline=True):
+    path = tmp_path / '000001.csv'
+    text = newline.join([HEADER] + rows) + (newline if final_newline else '')
+    path.write_bytes((b'\xef\xbb\xbf' if bom else b'') + text.encode('utf-8'))
+    return str(path)
+
+def assert_tail_matches(path, sizes=(1, 15, 300)):
+    full = read_csv(path)
+    for n in sizes:
+        expected = full.select(COLUMNS).slice(max(full.num_rows - n, 0))
+        assert read_csv_tail(path, n, COLUMNS).equals(expected), n
+
+def test_plain(tmp_path):
+    assert_tail_matches(write_file(tmp_path, make_rows(20)))
+
+def test_longer_than_first_block(tmp_path):
+    # 超过 TAIL_BLOCK，需要从块中间的不完整行开始截取
+    assert_tail_matches(write_file(tmp_path, make_rows(3000)))
+
+def test_blank_numeric_field(tmp_path):
+    rows = make_rows(20)
+    fields = rows[-1].split(',')
+    fields[11] = ''  # 换手率
+    fields[6] = ''   # 成交量 (float32 列)
+    rows[-1] = ','.join(fields)
+    path = write_file(tmp_path, rows)
+    assert_tail_matches(path)
+    assert read_csv_tail(path, 1, ['turnover']).column('turnover').null_count == 1
+
+def test_crlf(tmp_path):
+    assert_tail_matches(write_file(tmp_path, make_rows(20), newline='\r\n'))
+
+def test_bom(tmp_path):
+    assert_tail_matches(write_file(tmp_path, make_rows(20), bom=True))
+
+def test_no_final_newline(tmp_path):
+    assert_tail_matches(write_file(tmp_path, make_rows(20), final_newline=False))
+
+def test_header_only(tmp_path):
+    path = write_file(tmp_path, [])
+    assert_tail_matches(path)
+    assert read_csv_tail(path, 15, COLUMNS).num_rows == 0
+
+def test_fewer_rows_than_requested(tmp_path):
+    path = write_file(tmp_path, make_rows(3))
+    assert_tail_matches(path)
+    assert read_csv_tail(path, 300, COLUMNS).num_rows == 3
+
+def test_quoted_field_rejected(tmp_path):
+    rows = make_rows(20)
+    rows[-1] = rows[-1].replace('2024-01-', '"2024-01-', 1).replace(',000001', '",000001', 1)
+    with pytest.raises(ValueError):
+        read_csv_tail(write_file(tmp_path, rows), 15, COLUMNS)